@@ -0,0 +1,60 @@
+"""Long-running three-way match worker.
+
+The match index is held in memory, so incremental runs only pay off in a
+process that stays up between runs. Run this as its own process (not in
+the web instances, which are F1 and may be restarted at any time):
+
+    python -m app.match_worker --interval 300 --full-rescan-every 288
+
+Every `full_rescan_every` cycles the index is rebuilt from scratch. That
+picks up edited or deleted PRs, PO lines and receipts, and rows whose
+transaction committed later than the index overlap allows.
+"""
+import argparse
+import logging
+import time
+from .main import SessionLocal
+from .services.match_service import MatchIndex, MatchService
+
+logger = logging.getLogger(__name__)
+
+
+def run_worker(interval: int, full_rescan_every: int) -> None:
+    index = MatchIndex()
+    cycle = 0
+    while True:
+        if full_rescan_every and cycle % full_rescan_every == 0:
+            index.reset()
+        session = SessionLocal()
+        try:
+            report = MatchService(session, index).run_match()
+            logger.info(
+                "Match run: %d new PRs, %d new PO lines, %d new receipts; "
+                "%d unmatched receipts, %d over-receipts, %d budget conflicts, "
+                "%d unbudgeted PO lines, %d budgets with PO over PR",
+                report["new_purchase_requests"],
+                report["new_po_lines"],
+                report["new_receipts"],
+                len(report["unmatched_receipts"]),
+                len(report["over_receipts"]),
+                len(report["budget_conflicts"]),
+                len(report["unbudgeted_po_lines"]),
+                len(report["po_over_pr"])
+            )
+        except Exception:
+            # The index is left untouched by a failed run, so just retry later
+            logger.exception("Match run failed")
+        finally:
+            session.close()
+        cycle += 1
+        time.sleep(interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the PR / PO / receipt match incrementally")
+    parser.add_argument("--interval", type=int, default=300, help="seconds between runs")
+    parser.add_argument("--full-rescan-every", type=int, default=288,
+                        help="rebuild the index every N runs (0 to never rebuild)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    run_worker(args.interval, args.full_rescan_every)
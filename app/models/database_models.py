@@ -64,8 +64,8 @@ class Employee(Base):
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     cost_center = relationship("CostCenter")
-    manager = relationship("Employee", remote_side=[id])
-    reports = relationship("Employee", backref="manager_ref")
+    manager = relationship("Employee", remote_side=[id], back_populates="reports")
+    reports = relationship("Employee", back_populates="manager")
 
 class Budget(Base):
     __tablename__ = 'budget'
@@ -98,7 +98,7 @@ class PurchaseRequest(Base):
     requestor_ldap = Column(String(50), ForeignKey('employee.ldap'))
     amount = Column(Float, nullable=False)
     request_date = Column(DateTime, nullable=False)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
     
     budget = relationship("Budget", back_populates="purchase_requests")
     requestor = relationship("Employee", foreign_keys=[requestor_ldap])
@@ -114,11 +114,15 @@ class PurchaseOrder(Base):
     purchase_item = Column(String(255), nullable=False)
     amount = Column(Float, nullable=False)
     order_date = Column(DateTime, nullable=False)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
     
     budget = relationship("Budget", back_populates="purchase_orders")
     requestor = relationship("Employee", foreign_keys=[requestor_ldap])
-    receipts = relationship("Receipt", back_populates="purchase_order")
+    # Receipts reference PO lines by number only, so the join is read-only
+    receipts = relationship("Receipt",
+                            primaryjoin="and_(PurchaseOrder.po_number == foreign(Receipt.po_number), "
+                                        "PurchaseOrder.po_line_number == foreign(Receipt.po_line_number))",
+                            viewonly=True)
 
 class Receipt(Base):
     __tablename__ = 'receipt'
@@ -128,8 +132,10 @@ class Receipt(Base):
     po_line_number = Column(Integer, nullable=False)
     purchase_item = Column(String(255), nullable=False)
     receipt_date = Column(DateTime, nullable=False)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
     
-    purchase_order = relationship("PurchaseOrder", 
-                                foreign_keys=[po_number, po_line_number],
-                                back_populates="receipts")
\ No newline at end of file
+    purchase_order = relationship("PurchaseOrder",
+                                primaryjoin="and_(foreign(Receipt.po_number) == PurchaseOrder.po_number, "
+                                            "foreign(Receipt.po_line_number) == PurchaseOrder.po_line_number)",
+                                uselist=False,
+                                viewonly=True)
\ No newline at end of file
@@ -0,0 +1,335 @@
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from datetime import datetime, timedelta
+from sqlalchemy.orm import Session
+from ..models.database_models import PurchaseRequest, PurchaseOrder, Receipt
+
+PoLineKey = Tuple[str, int]
+
+SOURCES = ("purchase_request", "purchase_order", "receipt")
+
+class MatchIndex:
+    """Hash indexes and watermarks for the three-way match.
+
+    The index only lives in memory, so incremental runs need a long-lived
+    process that keeps the same MatchIndex between runs (see
+    app/match_worker.py). A fresh index always starts with a full scan.
+
+    Each source is read by created_at, starting `overlap` before the newest
+    timestamp seen, and rows already indexed in that window are skipped by
+    id. This catches rows whose transaction committed after a later row
+    was read, as long as it committed within `overlap` of its created_at.
+
+    PRs, PO lines and receipts have no updated_at, so edits and deletes to
+    indexed rows are not seen by incremental runs. Use
+    MatchService.resync_budgets() after changing PR or PO amounts. Call
+    reset() to force a full rescan after PO line numbers change or
+    receipts are deleted.
+    """
+
+    def __init__(self, tolerance: float = 0.01, overlap: timedelta = timedelta(hours=1)):
+        self.tolerance = tolerance
+        self.overlap = overlap
+        self.reset()
+
+    def reset(self) -> None:
+        """Drop all indexes so the next run rescans every line"""
+        # (po_number, po_line_number) -> budget_id / receipt count
+        self.po_lines: Dict[PoLineKey, Dict] = {}
+        # Receipts waiting for their PO line to show up
+        self.unmatched_receipts: Dict[PoLineKey, List[int]] = {}
+        self.over_receipts: Set[PoLineKey] = set()
+        # PO lines whose rows point at more than one budget, or at none
+        self.budget_conflicts: Dict[PoLineKey, Set[str]] = {}
+        self.unbudgeted_po_lines: Set[PoLineKey] = set()
+        # budget_id -> summed amounts
+        self.pr_totals: Dict[str, float] = {}
+        self.po_totals: Dict[str, float] = {}
+        self.po_over_pr: Set[str] = set()
+        # source -> newest created_at indexed, and ids indexed inside the overlap
+        self.watermarks: Dict[str, Optional[datetime]] = {source: None for source in SOURCES}
+        self.seen: Dict[str, Dict[int, Optional[datetime]]] = {source: {} for source in SOURCES}
+
+    def cutoff(self, source: str) -> Optional[datetime]:
+        """Earliest created_at the next incremental read must include"""
+        watermark = self.watermarks[source]
+        return watermark - self.overlap if watermark is not None else None
+
+    def is_indexed(self, source: str, row_id: int, created_at: Optional[datetime]) -> bool:
+        """Whether incremental runs have already read (or will never read) a row"""
+        cutoff = self.cutoff(source)
+        if cutoff is not None and (created_at is None or created_at < cutoff):
+            return True
+        return row_id in self.seen[source]
+
+    def apply(self, batch: "MatchBatch") -> None:
+        """Fold a fully read batch into the indexes"""
+        touched_budgets: Set[str] = set()
+
+        for budget_id, amount in batch.purchase_requests:
+            if budget_id is None:
+                continue
+            self.pr_totals[budget_id] = self.pr_totals.get(budget_id, 0.0) + amount
+            touched_budgets.add(budget_id)
+
+        for key, budget_id, amount in batch.po_lines:
+            line = self.po_lines.get(key)
+            if line is None:
+                line = {"budget_id": budget_id, "receipts": 0}
+                self.po_lines[key] = line
+                # Receipts that arrived before their PO line now match
+                pending = self.unmatched_receipts.pop(key, None)
+                if pending:
+                    self._add_receipts(key, line, len(pending))
+            elif line["budget_id"] != budget_id:
+                self.budget_conflicts.setdefault(key, {line["budget_id"]}).add(budget_id)
+            if budget_id is None:
+                # Not charged to any budget, so it is reported on its own
+                self.unbudgeted_po_lines.add(key)
+                continue
+            self.po_totals[budget_id] = self.po_totals.get(budget_id, 0.0) + amount
+            touched_budgets.add(budget_id)
+
+        for receipt_id, key in batch.receipts:
+            line = self.po_lines.get(key)
+            if line is None:
+                self.unmatched_receipts.setdefault(key, []).append(receipt_id)
+            else:
+                self._add_receipts(key, line, 1)
+
+        for source in SOURCES:
+            self._advance(source, batch.watermarks[source], batch.seen[source])
+
+        self.evaluate_budgets(touched_budgets)
+
+    def replace_totals(self, budget_ids: Iterable[str], batch: "MatchBatch") -> None:
+        """Overwrite PR and PO totals of the given budgets with a fresh read
+
+        The batch must only hold rows that are already indexed; newer rows
+        are added by the next run_match().
+        """
+        budget_ids = set(budget_ids)
+        for budget_id in budget_ids:
+            self.pr_totals.pop(budget_id, None)
+            self.po_totals.pop(budget_id, None)
+        for budget_id, amount in batch.purchase_requests:
+            self.pr_totals[budget_id] = self.pr_totals.get(budget_id, 0.0) + amount
+        for _, budget_id, amount in batch.po_lines:
+            self.po_totals[budget_id] = self.po_totals.get(budget_id, 0.0) + amount
+
+        self.evaluate_budgets(budget_ids)
+
+    def evaluate_budgets(self, budget_ids: Iterable[str]) -> None:
+        for budget_id in budget_ids:
+            po_total = self.po_totals.get(budget_id, 0.0)
+            pr_total = self.pr_totals.get(budget_id, 0.0)
+            if po_total - pr_total > self.tolerance:
+                self.po_over_pr.add(budget_id)
+            else:
+                self.po_over_pr.discard(budget_id)
+
+    def report(self) -> dict:
+        return {
+            "unmatched_receipts": [
+                {
+                    "receipt_id": receipt_id,
+                    "po_number": po_number,
+                    "po_line_number": line_number
+                }
+                for (po_number, line_number), receipt_ids in self.unmatched_receipts.items()
+                for receipt_id in receipt_ids
+            ],
+            "over_receipts": [
+                {
+                    "po_number": po_number,
+                    "po_line_number": line_number,
+                    "budget_id": self.po_lines[(po_number, line_number)]["budget_id"],
+                    "receipt_count": self.po_lines[(po_number, line_number)]["receipts"]
+                }
+                for po_number, line_number in sorted(self.over_receipts)
+            ],
+            "budget_conflicts": [
+                {
+                    "po_number": po_number,
+                    "po_line_number": line_number,
+                    "budget_ids": sorted(self.budget_conflicts[(po_number, line_number)], key=str)
+                }
+                for po_number, line_number in sorted(self.budget_conflicts)
+            ],
+            "unbudgeted_po_lines": [
+                {
+                    "po_number": po_number,
+                    "po_line_number": line_number
+                }
+                for po_number, line_number in sorted(self.unbudgeted_po_lines)
+            ],
+            "po_over_pr": [
+                {
+                    "budget_id": budget_id,
+                    "pr_amount": self.pr_totals.get(budget_id, 0.0),
+                    "po_amount": self.po_totals.get(budget_id, 0.0),
+                    "difference": self.po_totals.get(budget_id, 0.0) - self.pr_totals.get(budget_id, 0.0)
+                }
+                for budget_id in sorted(self.po_over_pr, key=str)
+            ]
+        }
+
+    def _add_receipts(self, key: PoLineKey, line: Dict, count: int) -> None:
+        # Receipts carry no quantity, so a PO line is fully received by a
+        # single receipt; anything beyond that is an over-receipt.
+        line["receipts"] += count
+        if line["receipts"] > 1:
+            self.over_receipts.add(key)
+
+    def _advance(self, source: str, watermark: Optional[datetime],
+                 seen: Dict[int, Optional[datetime]]) -> None:
+        if watermark is not None and (self.watermarks[source] is None
+                                      or watermark > self.watermarks[source]):
+            self.watermarks[source] = watermark
+        self.seen[source].update(seen)
+
+        # Ids older than the overlap are never read again, so stop tracking them
+        cutoff = self.cutoff(source)
+        if cutoff is not None:
+            self.seen[source] = {
+                row_id: created_at
+                for row_id, created_at in self.seen[source].items()
+                if created_at is not None and created_at >= cutoff
+            }
+
+
+class MatchBatch:
+    """Rows read in one run, staged until every source has been read
+
+    Only ids inside the overlap window are kept in `seen`; older rows are
+    never read again, so tracking them would only add to peak memory.
+    """
+
+    # Smallest `seen` size worth pruning at
+    PRUNE_MIN = 10000
+
+    def __init__(self, index: Optional[MatchIndex] = None):
+        self.purchase_requests: List[Tuple[str, float]] = []
+        self.po_lines: List[Tuple[PoLineKey, str, float]] = []
+        self.receipts: List[Tuple[int, PoLineKey]] = []
+        self.watermarks: Dict[str, Optional[datetime]] = {source: None for source in SOURCES}
+        self.seen: Dict[str, Dict[int, Optional[datetime]]] = {source: {} for source in SOURCES}
+        self._overlap = index.overlap if index is not None else None
+        self._start = dict(index.watermarks) if index is not None else dict(self.watermarks)
+        self._prune_at = {source: self.PRUNE_MIN for source in SOURCES}
+
+    def mark(self, source: str, row_id: int, created_at: Optional[datetime]) -> None:
+        watermark = self.watermarks[source]
+        if created_at is not None and (watermark is None or created_at > watermark):
+            self.watermarks[source] = created_at
+
+        floor = self._floor(source)
+        if floor is not None and (created_at is None or created_at < floor):
+            return
+        seen = self.seen[source]
+        seen[row_id] = created_at
+        if len(seen) >= self._prune_at[source]:
+            self._prune(source)
+
+    def _floor(self, source: str) -> Optional[datetime]:
+        """Earliest created_at that can still fall inside the final overlap"""
+        if self._overlap is None:
+            return None
+        watermarks = [w for w in (self.watermarks[source], self._start[source]) if w is not None]
+        return max(watermarks) - self._overlap if watermarks else None
+
+    def _prune(self, source: str) -> None:
+        floor = self._floor(source)
+        if floor is not None:
+            self.seen[source] = {
+                row_id: created_at
+                for row_id, created_at in self.seen[source].items()
+                if created_at is not None and created_at >= floor
+            }
+        # Grow the threshold so pruning stays amortised O(1) per row
+        self._prune_at[source] = max(2 * len(self.seen[source]), self.PRUNE_MIN)
+
+
+class MatchService:
+    """Three-way match of purchase requests, purchase orders and receipts.
+
+    Receipts only reference PO lines by (po_number, po_line_number), so the
+    match is done over the hash indexes of a MatchIndex instead of SQL
+    joins. Pass the same index to each run to process only new lines.
+    """
+
+    def __init__(self, db_session: Session, index: Optional[MatchIndex] = None,
+                 batch_size: int = 10000):
+        self.db = db_session
+        self.index = index if index is not None else MatchIndex()
+        self.batch_size = batch_size
+
+    def run_match(self) -> dict:
+        """Index new PRs, PO lines and receipts, then report exceptions"""
+        batch = MatchBatch(self.index)
+
+        for pr_id, created_at, budget_id, amount in self._stream(
+                PurchaseRequest, "purchase_request",
+                PurchaseRequest.budget_id, PurchaseRequest.amount):
+            batch.purchase_requests.append((budget_id, amount or 0.0))
+            batch.mark("purchase_request", pr_id, created_at)
+
+        for po_id, created_at, po_number, line_number, budget_id, amount in self._stream(
+                PurchaseOrder, "purchase_order",
+                PurchaseOrder.po_number, PurchaseOrder.po_line_number,
+                PurchaseOrder.budget_id, PurchaseOrder.amount):
+            batch.po_lines.append(((po_number, line_number), budget_id, amount or 0.0))
+            batch.mark("purchase_order", po_id, created_at)
+
+        for receipt_id, created_at, po_number, line_number in self._stream(
+                Receipt, "receipt", Receipt.po_number, Receipt.po_line_number):
+            batch.receipts.append((receipt_id, (po_number, line_number)))
+            batch.mark("receipt", receipt_id, created_at)
+
+        # Nothing reaches the index unless every source was read completely
+        self.index.apply(batch)
+
+        report = self.index.report()
+        report.update({
+            "new_purchase_requests": len(batch.purchase_requests),
+            "new_po_lines": len(batch.po_lines),
+            "new_receipts": len(batch.receipts)
+        })
+        return report
+
+    def resync_budgets(self, budget_ids: List[str]) -> dict:
+        """Re-read PR and PO totals of budgets whose lines were edited or deleted"""
+        batch = MatchBatch()
+
+        for pr_id, created_at, budget_id, amount in self.db.query(
+            PurchaseRequest.id,
+            PurchaseRequest.created_at,
+            PurchaseRequest.budget_id,
+            PurchaseRequest.amount
+        ).filter(PurchaseRequest.budget_id.in_(budget_ids)):
+            if self.index.is_indexed("purchase_request", pr_id, created_at):
+                batch.purchase_requests.append((budget_id, amount or 0.0))
+
+        for po_id, created_at, po_number, line_number, budget_id, amount in self.db.query(
+            PurchaseOrder.id,
+            PurchaseOrder.created_at,
+            PurchaseOrder.po_number,
+            PurchaseOrder.po_line_number,
+            PurchaseOrder.budget_id,
+            PurchaseOrder.amount
+        ).filter(PurchaseOrder.budget_id.in_(budget_ids)):
+            if self.index.is_indexed("purchase_order", po_id, created_at):
+                batch.po_lines.append(((po_number, line_number), budget_id, amount or 0.0))
+
+        self.index.replace_totals(budget_ids, batch)
+        return self.index.report()
+
+    def _stream(self, model, source: str, *columns):
+        """Yield (id, created_at, *columns) for rows not yet indexed"""
+        query = self.db.query(model.id, model.created_at, *columns)
+        cutoff = self.index.cutoff(source)
+        if cutoff is not None:
+            query = query.filter(model.created_at >= cutoff)
+        seen = self.index.seen[source]
+        for row in query.yield_per(self.batch_size):
+            if row[0] not in seen:
+                yield row
@@ -0,0 +1,274 @@
+from typing import Dict, List, Optional
+import numpy as np
+from sqlalchemy.orm import Session
+from sqlalchemy import func
+from ..models.database_models import AOP, AOPDetail, Budget, Employee, AOPState
+
+NO_COST_CENTER = -1
+
+class BudgetScenario:
+    """In-memory copy of an AOP's active budgets held as columnar arrays.
+
+    Rules mutate the arrays only; nothing touches the database until the
+    scenario is passed to SimulationService.commit_scenario().
+    """
+
+    def __init__(self, aop_id: int, budget_ids: np.ndarray, amounts: np.ndarray,
+                 levels: np.ndarray, has_level: np.ndarray, cost_center_ids: np.ndarray):
+        self.aop_id = aop_id
+        self.budget_ids = budget_ids
+        self.levels = levels
+        # Budgets without an employee have no level and never match level filters
+        self.has_level = has_level
+        self.cost_center_ids = cost_center_ids
+        self.original_amounts = amounts
+        self.amounts = amounts.copy()
+        self.aop_ids = np.full(len(budget_ids), aop_id, dtype=np.int64)
+        self.rules: List[dict] = []
+
+    def reset(self) -> None:
+        """Discard all applied rules"""
+        self.amounts = self.original_amounts.copy()
+        self.aop_ids = np.full(len(self.budget_ids), self.aop_id, dtype=np.int64)
+        self.rules = []
+
+    def select(self, min_level: Optional[int] = None, max_level: Optional[int] = None,
+               cost_center_ids: Optional[List[int]] = None,
+               in_aop_id: Optional[int] = None) -> np.ndarray:
+        """Boolean mask of budgets matching the given filters
+
+        Only budgets currently in `in_aop_id` are selected, which defaults
+        to the scenario's AOP, so budgets moved out by an earlier rule are
+        left alone.
+        """
+        mask = self.aop_ids == (self.aop_id if in_aop_id is None else in_aop_id)
+        if min_level is not None:
+            mask &= self.has_level & (self.levels >= min_level)
+        if max_level is not None:
+            mask &= self.has_level & (self.levels <= max_level)
+        if cost_center_ids is not None:
+            mask &= np.isin(self.cost_center_ids, cost_center_ids)
+        return mask
+
+    def apply_rule(self, min_level: Optional[int] = None, max_level: Optional[int] = None,
+                   cost_center_ids: Optional[List[int]] = None, scale: float = 1.0,
+                   move_to_aop_id: Optional[int] = None,
+                   in_aop_id: Optional[int] = None) -> int:
+        """Scale and/or move matching budgets, returning how many matched"""
+        if scale < 0:
+            raise ValueError("Scale factor cannot be negative")
+
+        mask = self.select(min_level, max_level, cost_center_ids, in_aop_id)
+        self.amounts[mask] *= scale
+        if move_to_aop_id is not None:
+            self.aop_ids[mask] = move_to_aop_id
+
+        self.rules.append({
+            "min_level": min_level,
+            "max_level": max_level,
+            "cost_center_ids": cost_center_ids,
+            "in_aop_id": in_aop_id,
+            "scale": scale,
+            "move_to_aop_id": move_to_aop_id
+        })
+        return int(mask.sum())
+
+    def changed_mask(self) -> np.ndarray:
+        return (self.amounts != self.original_amounts) | (self.aop_ids != self.aop_id)
+
+
+class SimulationService:
+    # Ids per SELECT ... FOR UPDATE when locking changed budgets
+    LOCK_CHUNK_SIZE = 500
+
+    def __init__(self, db_session: Session):
+        self.db = db_session
+        # aop_id -> limits and stored budget totals, refreshed on commit
+        self._baselines: Dict[int, dict] = {}
+
+    def load_scenario(self, aop_id: int) -> BudgetScenario:
+        """Load an AOP's active budgets into a new scenario"""
+        aop = self.db.query(AOP).filter(AOP.id == aop_id).first()
+        if not aop:
+            raise ValueError("AOP not found")
+
+        rows = self.db.query(
+            Budget.id,
+            Budget.amount,
+            Employee.level,
+            Employee.cost_center_id
+        ).outerjoin(Employee, Budget.employee_id == Employee.id).filter(
+            Budget.aop_id == aop_id,
+            Budget.is_active == True
+        ).all()
+
+        count = len(rows)
+        budget_ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=count)
+        amounts = np.fromiter((r[1] or 0.0 for r in rows), dtype=np.float64, count=count)
+        has_level = np.fromiter((r[2] is not None for r in rows), dtype=bool, count=count)
+        levels = np.fromiter((r[2] if r[2] is not None else 0 for r in rows),
+                             dtype=np.int64, count=count)
+        cost_center_ids = np.fromiter(
+            (r[3] if r[3] is not None else NO_COST_CENTER for r in rows),
+            dtype=np.int64, count=count)
+
+        return BudgetScenario(aop_id, budget_ids, amounts, levels, has_level, cost_center_ids)
+
+    def evaluate_scenario(self, scenario: BudgetScenario) -> dict:
+        """Report compliance of every AOP touched by the scenario"""
+        aop_ids = np.unique(np.append(scenario.aop_ids, scenario.aop_id))
+        results = {}
+        for aop_id in aop_ids.tolist():
+            baseline = self._get_baseline(aop_id)
+            existing = baseline["existing"]
+            if aop_id == scenario.aop_id:
+                existing = self._outside_scenario(existing, scenario)
+            mask = scenario.aop_ids == aop_id
+            results[aop_id] = self._check_compliance(
+                baseline,
+                existing,
+                scenario.amounts[mask],
+                scenario.cost_center_ids[mask]
+            )
+
+        return {
+            "aop_id": scenario.aop_id,
+            "changed_budgets": int(scenario.changed_mask().sum()),
+            "aops": results,
+            "is_compliant": all(r["is_compliant"] for r in results.values())
+        }
+
+    def commit_scenario(self, scenario: BudgetScenario) -> dict:
+        """Write a compliant scenario's budget changes back to the database"""
+        aop_ids = np.unique(np.append(scenario.aop_ids, scenario.aop_id)).tolist()
+
+        # Lock the AOPs and re-check them in the same transaction as the update
+        aops = self.db.query(AOP).filter(AOP.id.in_(aop_ids)).with_for_update().all()
+        if any(aop.state == AOPState.ACTIVE for aop in aops):
+            self.db.rollback()
+            raise ValueError("Cannot modify active AOP directly")
+
+        self._baselines.clear()
+        report = self.evaluate_scenario(scenario)
+        if not report["is_compliant"]:
+            self.db.rollback()
+            raise ValueError("Scenario exceeds AOP limits")
+
+        # Lock the changed budgets and reject the scenario if any were edited,
+        # moved or deactivated since it was loaded
+        changed = scenario.changed_mask()
+        budget_ids = scenario.budget_ids[changed].tolist()
+        loaded_amounts = dict(zip(budget_ids, scenario.original_amounts[changed].tolist()))
+        current = {}
+        for start in range(0, len(budget_ids), self.LOCK_CHUNK_SIZE):
+            current.update(self.db.query(Budget.id, Budget.amount).filter(
+                Budget.id.in_(budget_ids[start:start + self.LOCK_CHUNK_SIZE]),
+                Budget.aop_id == scenario.aop_id,
+                Budget.is_active == True
+            ).with_for_update())
+        stale = [
+            budget_id for budget_id in budget_ids
+            if current.get(budget_id) != loaded_amounts[budget_id]
+        ]
+        if stale:
+            self.db.rollback()
+            raise ValueError(f"Budget {stale[0]} changed since the scenario was loaded")
+
+        self.db.bulk_update_mappings(Budget, [
+            {"id": budget_id, "amount": amount, "aop_id": aop_id}
+            for budget_id, amount, aop_id in zip(
+                budget_ids,
+                scenario.amounts[changed].tolist(),
+                scenario.aop_ids[changed].tolist()
+            )
+        ])
+        self.db.commit()
+
+        # Committed state becomes the new baseline; moved budgets leave the scenario
+        self._baselines.clear()
+        keep = scenario.aop_ids == scenario.aop_id
+        scenario.budget_ids = scenario.budget_ids[keep]
+        scenario.levels = scenario.levels[keep]
+        scenario.has_level = scenario.has_level[keep]
+        scenario.cost_center_ids = scenario.cost_center_ids[keep]
+        scenario.original_amounts = scenario.amounts[keep]
+        scenario.reset()
+        report["committed_budgets"] = int(changed.sum())
+        return report
+
+    def _get_baseline(self, aop_id: int) -> dict:
+        """AOP limits and the active budgets currently stored in the AOP"""
+        if aop_id in self._baselines:
+            return self._baselines[aop_id]
+
+        aop = self.db.query(AOP).filter(AOP.id == aop_id).first()
+        if not aop:
+            raise ValueError(f"AOP {aop_id} not found")
+
+        limits = dict(self.db.query(
+            AOPDetail.cost_center_id,
+            func.sum(AOPDetail.amount)
+        ).filter(
+            AOPDetail.aop_id == aop_id
+        ).group_by(AOPDetail.cost_center_id).all())
+
+        existing = dict(self.db.query(
+            Employee.cost_center_id,
+            func.sum(Budget.amount)
+        ).outerjoin(Employee, Budget.employee_id == Employee.id).filter(
+            Budget.aop_id == aop_id,
+            Budget.is_active == True
+        ).group_by(Employee.cost_center_id).all())
+
+        baseline = {
+            "total_amount": aop.total_amount,
+            "limits": {cc: amount or 0.0 for cc, amount in limits.items() if cc is not None},
+            "existing": {
+                (cc if cc is not None else NO_COST_CENTER): amount or 0.0
+                for cc, amount in existing.items()
+            }
+        }
+        self._baselines[aop_id] = baseline
+        return baseline
+
+    def _outside_scenario(self, existing: dict, scenario: BudgetScenario) -> dict:
+        """Stored budgets of the scenario's AOP that the scenario does not hold"""
+        unique_ccs, inverse = np.unique(scenario.cost_center_ids, return_inverse=True)
+        cc_totals = np.bincount(inverse, weights=scenario.original_amounts,
+                                minlength=len(unique_ccs))
+
+        outside = dict(existing)
+        for cc, amount in zip(unique_ccs.tolist(), cc_totals.tolist()):
+            outside[cc] = outside.get(cc, 0.0) - amount
+        # Drop float residue left over from subtracting the scenario's own budgets
+        return {cc: round(amount, 6) for cc, amount in outside.items() if round(amount, 6) != 0}
+
+    def _check_compliance(self, baseline: dict, existing: dict, amounts: np.ndarray,
+                          cost_center_ids: np.ndarray) -> dict:
+        unique_ccs, inverse = np.unique(cost_center_ids, return_inverse=True)
+        cc_totals = np.bincount(inverse, weights=amounts, minlength=len(unique_ccs))
+
+        by_cost_center = dict(existing)
+        for cc, amount in zip(unique_ccs.tolist(), cc_totals.tolist()):
+            by_cost_center[cc] = by_cost_center.get(cc, 0.0) + amount
+
+        total_budget = float(amounts.sum()) + sum(existing.values())
+        violations = [
+            {
+                "cost_center_id": cc,
+                "limit": limit,
+                "total_budget": by_cost_center.get(cc, 0.0),
+                "difference": limit - by_cost_center.get(cc, 0.0)
+            }
+            for cc, limit in baseline["limits"].items()
+            if by_cost_center.get(cc, 0.0) > limit
+        ]
+
+        return {
+            "aop_amount": baseline["total_amount"],
+            "total_budget": total_budget,
+            "difference": baseline["total_amount"] - total_budget,
+            "cost_center_budgets": by_cost_center,
+            "cost_center_violations": violations,
+            "is_compliant": total_budget <= baseline["total_amount"] and not violations
+        }
@@ -0,0 +1,393 @@
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+from app.models.database_models import (
+    Base, AOP, AOPDetail, AOPState, Budget, CostCenter, Employee,
+    PurchaseRequest, PurchaseOrder, Receipt
+)
+from app.services.match_service import MatchBatch, MatchIndex, MatchService
+from app.services.simulation_service import SimulationService
+
+NOW = datetime(2024, 1, 15, 12, 0, 0)
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def budgets(db):
+    aop = AOP(name="FY24", total_amount=1000.0)
+    db.add(aop)
+    db.flush()
+    for budget_id in ("B1", "B2"):
+        db.add(Budget(budget_id=budget_id, aop_id=aop.id, project="Project", amount=500.0))
+    db.commit()
+
+
+def add_pr(db, reference, budget_id, amount, created_at=NOW):
+    db.add(PurchaseRequest(pr_reference=reference, budget_id=budget_id, amount=amount,
+                           request_date=created_at, created_at=created_at))
+    db.commit()
+
+
+def add_po(db, po_number, line_number, budget_id, amount, created_at=NOW):
+    po = PurchaseOrder(po_number=po_number, po_line_number=line_number, budget_id=budget_id,
+                       purchase_item="Laptop", amount=amount, order_date=created_at,
+                       created_at=created_at)
+    db.add(po)
+    db.commit()
+    return po
+
+
+def add_receipt(db, po_number, line_number, created_at=NOW):
+    receipt = Receipt(po_number=po_number, po_line_number=line_number, purchase_item="Laptop",
+                      receipt_date=created_at, created_at=created_at)
+    db.add(receipt)
+    db.commit()
+    return receipt
+
+
+class TestMatchService:
+    def test_receipt_before_po_line_is_matched_later(self, db, budgets):
+        index = MatchIndex()
+        add_pr(db, "PR1", "B1", 100.0)
+        receipt = add_receipt(db, "PO1", 1)
+
+        report = MatchService(db, index).run_match()
+        assert [r["receipt_id"] for r in report["unmatched_receipts"]] == [receipt.id]
+
+        add_po(db, "PO1", 1, "B1", 100.0, created_at=NOW + timedelta(minutes=5))
+        report = MatchService(db, index).run_match()
+        assert report["unmatched_receipts"] == []
+        assert report["over_receipts"] == []
+
+    def test_over_receipt(self, db, budgets):
+        add_pr(db, "PR1", "B1", 100.0)
+        add_po(db, "PO1", 1, "B1", 100.0)
+        add_receipt(db, "PO1", 1)
+        add_receipt(db, "PO1", 1)
+
+        report = MatchService(db).run_match()
+        assert report["over_receipts"] == [
+            {"po_number": "PO1", "po_line_number": 1, "budget_id": "B1", "receipt_count": 2}
+        ]
+
+    def test_po_over_pr_clears_when_pr_added(self, db, budgets):
+        index = MatchIndex()
+        add_pr(db, "PR1", "B1", 100.0)
+        add_po(db, "PO1", 1, "B1", 150.0)
+
+        report = MatchService(db, index).run_match()
+        assert [r["budget_id"] for r in report["po_over_pr"]] == ["B1"]
+        assert report["po_over_pr"][0]["difference"] == pytest.approx(50.0)
+
+        add_pr(db, "PR2", "B1", 50.0, created_at=NOW + timedelta(minutes=5))
+        report = MatchService(db, index).run_match()
+        assert report["po_over_pr"] == []
+
+    def test_rerun_only_reads_new_rows(self, db, budgets):
+        index = MatchIndex()
+        add_pr(db, "PR1", "B1", 100.0)
+        add_po(db, "PO1", 1, "B1", 100.0)
+        add_receipt(db, "PO1", 1)
+
+        report = MatchService(db, index).run_match()
+        assert (report["new_purchase_requests"], report["new_po_lines"], report["new_receipts"]) == (1, 1, 1)
+
+        report = MatchService(db, index).run_match()
+        assert (report["new_purchase_requests"], report["new_po_lines"], report["new_receipts"]) == (0, 0, 0)
+        assert index.pr_totals["B1"] == pytest.approx(100.0)
+
+        add_po(db, "PO2", 1, "B2", 20.0, created_at=NOW + timedelta(minutes=5))
+        report = MatchService(db, index).run_match()
+        assert (report["new_purchase_requests"], report["new_po_lines"], report["new_receipts"]) == (0, 1, 0)
+        assert [r["budget_id"] for r in report["po_over_pr"]] == ["B2"]
+
+    def test_late_commit_inside_overlap_is_picked_up(self, db, budgets):
+        index = MatchIndex(overlap=timedelta(minutes=10))
+        add_pr(db, "PR1", "B1", 100.0, created_at=NOW)
+        MatchService(db, index).run_match()
+
+        # Inserted with an earlier timestamp than the watermark, committed later
+        add_pr(db, "PR2", "B1", 30.0, created_at=NOW - timedelta(minutes=5))
+        report = MatchService(db, index).run_match()
+        assert report["new_purchase_requests"] == 1
+        assert index.pr_totals["B1"] == pytest.approx(130.0)
+
+    def test_full_scan_only_tracks_ids_inside_overlap(self, db, budgets, monkeypatch):
+        monkeypatch.setattr(MatchBatch, "PRUNE_MIN", 2)
+        index = MatchIndex(overlap=timedelta(minutes=10))
+        for i in range(5):
+            add_pr(db, f"PR{i}", "B1", 10.0, created_at=NOW + timedelta(hours=i))
+        batch = MatchBatch(index)
+        for pr_id, created_at in db.query(PurchaseRequest.id, PurchaseRequest.created_at):
+            batch.mark("purchase_request", pr_id, created_at)
+            assert len(batch.seen["purchase_request"]) <= 2
+
+        report = MatchService(db, index).run_match()
+        assert report["new_purchase_requests"] == 5
+        assert len(index.seen["purchase_request"]) == 1
+        assert index.pr_totals["B1"] == pytest.approx(50.0)
+
+    def test_failed_run_leaves_index_untouched(self, db, budgets, monkeypatch):
+        index = MatchIndex()
+        add_pr(db, "PR1", "B1", 100.0)
+        add_po(db, "PO1", 1, "B1", 150.0)
+        service = MatchService(db, index)
+
+        def fail_on_receipts(model, source, *columns):
+            if source == "receipt":
+                raise RuntimeError("connection lost")
+            return MatchService._stream(service, model, source, *columns)
+
+        monkeypatch.setattr(service, "_stream", fail_on_receipts)
+        with pytest.raises(RuntimeError):
+            service.run_match()
+        assert index.pr_totals == {}
+        assert index.watermarks["purchase_request"] is None
+
+        report = MatchService(db, index).run_match()
+        assert [r["budget_id"] for r in report["po_over_pr"]] == ["B1"]
+
+    def test_conflicting_budget_on_po_line(self, db, budgets):
+        add_pr(db, "PR1", "B1", 100.0)
+        add_pr(db, "PR2", "B2", 100.0)
+        add_po(db, "PO1", 1, "B1", 50.0)
+        add_po(db, "PO1", 1, "B2", 50.0)
+
+        report = MatchService(db).run_match()
+        assert report["budget_conflicts"] == [
+            {"po_number": "PO1", "po_line_number": 1, "budget_ids": ["B1", "B2"]}
+        ]
+
+    def test_unbudgeted_po_line_is_not_a_budget(self, db, budgets):
+        add_po(db, "PO1", 1, None, 5.0)
+
+        report = MatchService(db).run_match()
+        assert report["po_over_pr"] == []
+        assert report["unbudgeted_po_lines"] == [{"po_number": "PO1", "po_line_number": 1}]
+
+    def test_resync_budgets_picks_up_edits(self, db, budgets):
+        index = MatchIndex()
+        add_pr(db, "PR1", "B1", 100.0)
+        po = add_po(db, "PO1", 1, "B1", 100.0)
+        MatchService(db, index).run_match()
+
+        po.amount = 180.0
+        db.commit()
+        # Not yet indexed, so the resync must leave it to the next run
+        add_pr(db, "PR2", "B1", 50.0, created_at=NOW + timedelta(minutes=5))
+
+        report = MatchService(db, index).resync_budgets(["B1"])
+        assert index.po_totals["B1"] == pytest.approx(180.0)
+        assert index.pr_totals["B1"] == pytest.approx(100.0)
+        assert [r["budget_id"] for r in report["po_over_pr"]] == ["B1"]
+
+        report = MatchService(db, index).run_match()
+        assert index.pr_totals["B1"] == pytest.approx(150.0)
+        assert [r["budget_id"] for r in report["po_over_pr"]] == ["B1"]
+
+
+@pytest.fixture
+def plan(db):
+    """Two AOPs with cost center limits and budgets owned by L9 / L5 employees"""
+    cc1 = CostCenter(code="CC1", name="Engineering")
+    cc2 = CostCenter(code="CC2", name="Sales")
+    db.add_all([cc1, cc2])
+    db.flush()
+
+    def employee(ldap, level, cost_center):
+        emp = Employee(ldap=ldap, first_name=ldap, last_name="Test", email=f"{ldap}@example.com",
+                       level=level, cost_center_id=cost_center.id)
+        db.add(emp)
+        return emp
+
+    senior = employee("senior", 9, cc1)
+    junior = employee("junior", 5, cc1)
+    seller = employee("seller", 9, cc2)
+    source = AOP(name="FY24", total_amount=1000.0)
+    target = AOP(name="FY24 H2", total_amount=500.0)
+    db.add_all([source, target])
+    db.flush()
+
+    db.add_all([
+        AOPDetail(aop_id=source.id, cost_center_id=cc1.id, amount=600.0),
+        AOPDetail(aop_id=source.id, cost_center_id=cc2.id, amount=400.0),
+        AOPDetail(aop_id=target.id, cost_center_id=cc1.id, amount=300.0),
+    ])
+    budgets = {
+        "senior": Budget(budget_id="S1", aop_id=source.id, employee_id=senior.id, project="A", amount=300.0),
+        "junior": Budget(budget_id="J1", aop_id=source.id, employee_id=junior.id, project="A", amount=200.0),
+        "seller": Budget(budget_id="C1", aop_id=source.id, employee_id=seller.id, project="B", amount=300.0),
+        "unassigned": Budget(budget_id="U1", aop_id=source.id, project="C", amount=100.0),
+        "existing": Budget(budget_id="T1", aop_id=target.id, employee_id=junior.id, project="D", amount=100.0),
+    }
+    db.add_all(budgets.values())
+    db.commit()
+    return {"source": source, "target": target, "cc1": cc1, "cc2": cc2, "budgets": budgets}
+
+
+class TestSimulationService:
+    def test_scale_rule(self, db, plan):
+        service = SimulationService(db)
+        scenario = service.load_scenario(plan["source"].id)
+
+        matched = scenario.apply_rule(min_level=8, cost_center_ids=[plan["cc1"].id], scale=0.9)
+        assert matched == 1
+
+        report = service.evaluate_scenario(scenario)
+        source = report["aops"][plan["source"].id]
+        assert report["changed_budgets"] == 1
+        assert source["total_budget"] == pytest.approx(870.0)
+        assert source["cost_center_budgets"][plan["cc1"].id] == pytest.approx(470.0)
+        assert report["is_compliant"]
+        # Nothing is written until the scenario is committed
+        db.refresh(plan["budgets"]["senior"])
+        assert plan["budgets"]["senior"].amount == 300.0
+
+    def test_move_rule_counts_against_target_aop(self, db, plan):
+        service = SimulationService(db)
+        scenario = service.load_scenario(plan["source"].id)
+        scenario.apply_rule(min_level=8, cost_center_ids=[plan["cc1"].id], scale=0.5,
+                            move_to_aop_id=plan["target"].id)
+
+        report = service.evaluate_scenario(scenario)
+        target = report["aops"][plan["target"].id]
+        assert target["total_budget"] == pytest.approx(250.0)
+        assert target["cost_center_budgets"][plan["cc1"].id] == pytest.approx(250.0)
+        assert report["aops"][plan["source"].id]["total_budget"] == pytest.approx(600.0)
+        assert report["is_compliant"]
+
+    def test_cost_center_violation(self, db, plan):
+        service = SimulationService(db)
+        scenario = service.load_scenario(plan["source"].id)
+        scenario.apply_rule(cost_center_ids=[plan["cc2"].id], scale=1.5)
+
+        report = service.evaluate_scenario(scenario)
+        source = report["aops"][plan["source"].id]
+        assert source["total_budget"] == pytest.approx(1050.0)
+        assert [v["cost_center_id"] for v in source["cost_center_violations"]] == [plan["cc2"].id]
+        assert not report["is_compliant"]
+
+    def test_rules_skip_budgets_moved_by_earlier_rules(self, db, plan):
+        scenario = SimulationService(db).load_scenario(plan["source"].id)
+        scenario.apply_rule(min_level=8, cost_center_ids=[plan["cc1"].id],
+                            move_to_aop_id=plan["target"].id)
+
+        assert scenario.apply_rule(cost_center_ids=[plan["cc1"].id], scale=0.5) == 1
+        assert scenario.apply_rule(in_aop_id=plan["target"].id, scale=0.5) == 1
+
+    def test_level_rules_skip_unassigned_budgets(self, db, plan):
+        scenario = SimulationService(db).load_scenario(plan["source"].id)
+
+        assert scenario.apply_rule(max_level=6, scale=0.5) == 1
+        assert scenario.apply_rule(scale=0.5) == 4
+
+    def test_commit_writes_changes(self, db, plan):
+        service = SimulationService(db)
+        scenario = service.load_scenario(plan["source"].id)
+        scenario.apply_rule(min_level=8, cost_center_ids=[plan["cc1"].id], scale=0.5,
+                            move_to_aop_id=plan["target"].id)
+
+        report = service.commit_scenario(scenario)
+        assert report["committed_budgets"] == 1
+        senior = plan["budgets"]["senior"]
+        db.refresh(senior)
+        assert (senior.amount, senior.aop_id) == (150.0, plan["target"].id)
+        assert len(scenario.budget_ids) == 3
+
+    def test_commit_rejects_non_compliant_scenario(self, db, plan):
+        service = SimulationService(db)
+        scenario = service.load_scenario(plan["source"].id)
+        scenario.apply_rule(cost_center_ids=[plan["cc2"].id], scale=1.5)
+
+        with pytest.raises(ValueError, match="exceeds AOP limits"):
+            service.commit_scenario(scenario)
+        db.refresh(plan["budgets"]["seller"])
+        assert plan["budgets"]["seller"].amount == 300.0
+
+    def test_commit_rejects_active_aop(self, db, plan):
+        plan["target"].state = AOPState.ACTIVE
+        db.commit()
+        service = SimulationService(db)
+        scenario = service.load_scenario(plan["source"].id)
+        scenario.apply_rule(min_level=8, cost_center_ids=[plan["cc1"].id],
+                            move_to_aop_id=plan["target"].id)
+
+        with pytest.raises(ValueError, match="active AOP"):
+            service.commit_scenario(scenario)
+
+    def test_commit_rejects_stale_budgets(self, db, plan):
+        service = SimulationService(db)
+        scenario = service.load_scenario(plan["source"].id)
+        scenario.apply_rule(scale=0.5)
+
+        plan["budgets"]["junior"].amount = 150.0
+        db.commit()
+
+        with pytest.raises(ValueError, match="changed since the scenario was loaded"):
+            service.commit_scenario(scenario)
+        db.refresh(plan["budgets"]["senior"])
+        assert plan["budgets"]["senior"].amount == 300.0
+
+    def test_commit_rechecks_limits(self, db, plan):
+        service = SimulationService(db)
+        scenario = service.load_scenario(plan["source"].id)
+        scenario.apply_rule(min_level=8, cost_center_ids=[plan["cc1"].id], scale=0.5,
+                            move_to_aop_id=plan["target"].id)
+        assert service.evaluate_scenario(scenario)["is_compliant"]
+
+        # Limits tightened after the scenario was evaluated
+        db.query(AOPDetail).filter(AOPDetail.aop_id == plan["target"].id).update({"amount": 200.0})
+        db.commit()
+
+        with pytest.raises(ValueError, match="exceeds AOP limits"):
+            service.commit_scenario(scenario)
+
+    def test_budgets_added_after_load_count_against_source(self, db, plan):
+        service = SimulationService(db)
+        scenario = service.load_scenario(plan["source"].id)
+        db.add(Budget(budget_id="N1", aop_id=plan["source"].id, project="E", amount=150.0))
+        db.commit()
+
+        report = service.evaluate_scenario(scenario)
+        assert report["aops"][plan["source"].id]["total_budget"] == pytest.approx(1050.0)
+        assert not report["is_compliant"]
+
+    def test_commit_rejects_deactivated_budgets(self, db, plan):
+        service = SimulationService(db)
+        scenario = service.load_scenario(plan["source"].id)
+        scenario.apply_rule(scale=0.5)
+
+        plan["budgets"]["seller"].is_active = False
+        db.commit()
+
+        with pytest.raises(ValueError, match="changed since the scenario was loaded"):
+            service.commit_scenario(scenario)
+        db.refresh(plan["budgets"]["senior"])
+        assert plan["budgets"]["senior"].amount == 300.0
+
+    def test_commit_updates_many_budgets(self, db, plan):
+        plan["source"].total_amount = 100000.0
+        db.add_all([
+            Budget(budget_id=f"M{i}", aop_id=plan["source"].id, project="Bulk", amount=10.0)
+            for i in range(1200)
+        ])
+        db.commit()
+        service = SimulationService(db)
+        scenario = service.load_scenario(plan["source"].id)
+        scenario.apply_rule(scale=0.5)
+
+        report = service.commit_scenario(scenario)
+        assert report["committed_budgets"] == 1204
+        total = db.query(func.sum(Budget.amount)).filter(Budget.aop_id == plan["source"].id).scalar()
+        assert total == pytest.approx(0.5 * (12000.0 + 900.0))